@@ -1,32 +1,267 @@
 import os
-import re
-import matplotlib.pyplot as plt
-from collections import defaultdict
+import pickle
+import sys
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+# google-re2 (DFA, sans backtracking) si disponible, sinon le module standard
+try:
+    import re2 as re
+except ImportError:
+    import re
+
+# Hyperscan (correspondance multi-motifs SIMD) si disponible, sinon _SCAN_RE
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+# Un seul motif pour les directives et les G-code : le fichier est parcouru une
+# seule fois et lastindex indique la branche (1 = directive, 2 = G-code).
+# Appliqué au fichier entier : '^' en mode multiligne remplace le strip() par ligne.
+# La branche directive ne consomme pas la macro, pour qu'un G-code qui suit
+# (#ifdef G29) soit encore vu ; la macro est lue ensuite avec _MACRO_RE.
+# Motifs en bytes : le contenu brut est analysé sans décodage UTF-8 préalable
+_SCAN_RE = re.compile(rb'(?m)^[ \t]*#[ \t]*(ifdef|ifndef|if|elif|else|endif|define|undef)\b'
+                      rb'|\bG([0-9]{1,2})\b')
+_MACRO_RE = re.compile(rb'[ \t]*(\w+)')
+
+# Même balayage avec Hyperscan : les deux motifs sont cherchés en une passe dans le
+# moteur C ; SOM_LEFTMOST fournit aussi le début de chaque occurrence
+if hyperscan is not None:
+    _HS_DATABASE = hyperscan.Database()
+    _HS_DATABASE.compile(
+        expressions=[rb'^[ \t]*#[ \t]*(ifdef|ifndef|if|elif|else|endif|define|undef)\b',
+                     rb'\bG[0-9]{1,2}\b'],
+        ids=[1, 2],
+        elements=2,
+        flags=[hyperscan.HS_FLAG_MULTILINE | hyperscan.HS_FLAG_SOM_LEFTMOST] * 2)
+else:
+    _HS_DATABASE = None
+
+# Nom de directive brut -> str, sans décodage par occurrence
+_DIRECTIVE_NAMES = {name.encode(): name for name in
+                    ('ifdef', 'ifndef', 'if', 'elif', 'else', 'endif', 'define', 'undef')}
+
+def _scan_events(data: bytes):
+    # Occurrences (1 = directive | 2 = G-code, début, fin) dans l'ordre du fichier
+    if _HS_DATABASE is not None:
+        events = []
+        add_event = events.append
+
+        def on_match(pattern_id, start, end, flags, context):
+            add_event((pattern_id, start, end))
+
+        _HS_DATABASE.scan(data, match_event_handler=on_match)
+        return events
+    return [(match.lastindex, match.start(), match.end()) for match in _SCAN_RE.finditer(data)]
+
+def _iter_with_line_numbers(data: bytes, events):
+    # Numéro de ligne calculé à la demande, en avançant depuis l'occurrence précédente
+    line_num, pos = 1, 0
+    for event in events:
+        start = event[1]
+        line_num += data.count(b'\n', pos, start)
+        pos = start
+        yield line_num, event
+
+def _iter_source_files(root: str, extensions):
+    # Équivalent de os.walk (même ordre, liens vers dossiers non suivis) mais garde les
+    # DirEntry de scandir : le type est connu sans stat() supplémentaire par entrée
+    subdirs = []
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.endswith(extensions) and not entry.is_dir():
+                    yield entry.path
+    except OSError:
+        return
+    for subdir in subdirs:
+        yield from _iter_source_files(subdir, extensions)
+
+def _analyze_file_worker(file_path: str, collect_details: bool = False):
+    # Analyse d'un fichier dans un processus du pool. Ne dépend d'aucun état global :
+    # renvoie des dicts/listes simples que CodeAnalyzer fusionne dans l'ordre des fichiers.
+    #   - macro_events : (directive, macro) pour define/undef/ifdef/ifndef, rejoués
+    #     dans l'ordre car undefined_macros dépend des #define des fichiers précédents
+    #   - max_depth : profondeur maximale des #if imbriqués dans ce fichier ; compteur
+    #     local, un #endif en trop (en-têtes) ne déborde plus sur les fichiers suivants
+    #   - gcode_codes / gcode_lines : code et numéro de ligne de chaque occurrence,
+    #     vides si collect_details est faux
+    directive_counts = Counter()
+    macro_events = []
+    depth = 0
+    max_depth = 0
+    gcode_stats = Counter()
+    gcode_codes = []
+    gcode_lines = array('i')
+    try:
+        # Lecture du fichier en un bloc, puis un seul balayage regex.
+        # Sans tampon : readall() dimensionne la lecture via fstat, une seule copie
+        with open(file_path, 'rb', buffering=0) as file:
+            data = file.read()
+
+        # Fichier ignoré sans aucun '#' ni 'G' (tests memchr)
+        if b'#' in data or b'G' in data:
+            # Méthodes liées en variables locales : pas de recherche d'attribut par match
+            directives = []
+            add_directive = directives.append
+            gcode_numbers = []
+            add_gcode = gcode_numbers.append
+            add_macro_event = macro_events.append
+            add_line = gcode_lines.append
+            match_macro = _MACRO_RE.match
+            # Numéros de ligne seulement nécessaires au détail des G-code
+            events = _scan_events(data)
+            if collect_details:
+                events = _iter_with_line_numbers(data, events)
+            else:
+                events = zip(repeat(None), events)
+            for line_num, (kind, start, end) in events:
+                if kind == 1:
+                    # Analyse directives préprocesseur
+                    directive = _DIRECTIVE_NAMES[data[start:end].lstrip(b' \t#')]
+                    add_directive(directive)
+
+                    if directive in {'ifdef', 'ifndef', 'if'}:
+                        depth += 1
+                        if depth > max_depth:
+                            max_depth = depth
+                    elif directive == 'endif':
+                        if depth:
+                            depth -= 1
+
+                    if directive in {'define', 'undef', 'ifdef', 'ifndef'}:
+                        macro_match = match_macro(data, end)
+                        if macro_match:
+                            # \w en bytes ne capture que de l'ASCII
+                            add_macro_event((directive, macro_match.group(1).decode('ascii')))
+                else:
+                    # Recherche de G-code (dans TOUTES les lignes, y compris commentées)
+                    add_gcode(data[start + 1:end])
+
+                    # Détail par occurrence : seul le numéro de ligne est conservé ici,
+                    # les codes sont reconstruits après la boucle depuis gcode_numbers
+                    if collect_details:
+                        add_line(line_num)
+
+            # Comptage en un seul appel (boucle C de Counter) plutôt qu'un += 1 par match ;
+            # le préfixe 'G' et le décodage ne sont faits qu'une fois par code distinct
+            directive_counts.update(directives)
+            names = {}
+            for number, count in Counter(gcode_numbers).items():
+                names[number] = name = 'G' + number.decode('ascii')
+                gcode_stats[name] = count
+            if collect_details:
+                gcode_codes = list(map(names.__getitem__, gcode_numbers))
+    except Exception as e:
+        print(f"Error reading {file_path}: {e}")
+        return None
+
+    return directive_counts, macro_events, max_depth, gcode_stats, gcode_codes, gcode_lines
+
+# Cache des résultats par fichier, réutilisés tant que (mtime, taille) n'ont pas changé.
+# _CACHE_VERSION est à incrémenter dès que le format des résultats du worker change.
+_DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'marlin_analyzer', 'cache.pkl')
+_CACHE_VERSION = 3
+
+def _load_cache(cache_path: str) -> dict:
+    # Cache absent, illisible ou d'une autre version : on repart d'un cache vide
+    try:
+        with open(cache_path, 'rb') as file:
+            version, entries = pickle.load(file)
+    except Exception:
+        return {}
+    return entries if version == _CACHE_VERSION else {}
+
+def _save_cache(cache_path: str, entries: dict):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Écriture dans un fichier temporaire puis remplacement : pas de cache tronqué
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump((_CACHE_VERSION, entries), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Error writing cache {cache_path}: {e}")
 
 class CodeAnalyzer:
-    def __init__(self, root_dir: str):
+    def __init__(self, root_dir: str, collect_details: bool = False,
+                 cache_path: str = _DEFAULT_CACHE_PATH):
         self.root_dir = root_dir
-        self.directive_counts = defaultdict(int)
+        self.collect_details = collect_details
+        # None désactive le cache
+        self.cache_path = cache_path
+        self.directive_counts = Counter()
         self.defined_macros = set()
-        self.undefined_macros = defaultdict(int)
-        self.condition_stack = []
+        self.undefined_macros = {}
+        self.max_depth = 0
         self.files_analyzed = 0
 
-        # Pour les G-code
-        self.gcode_stats = defaultdict(int)
-        self.gcode_instructions = []
+        # Pour les G-code. Détail par occurrence (rempli seulement si collect_details)
+        # en colonnes parallèles : gi_code[i], files[gi_file_id[i]], gi_line[i]
+        self.gcode_stats = Counter()
+        self.files = []
+        self._file_idx = {}
+        self.gi_file_id = array('i')
+        self.gi_line = array('i')
+        self.gi_code = []
+
+    def analyze_codebase(self, plot: bool = False, out: str = None, quiet: bool = False):
+        file_paths = list(_iter_source_files(self.root_dir, ('.c', '.h')))
+        results = [None] * len(file_paths)
+
+        # Résultats repris du cache quand (mtime, taille) correspondent : seuls les
+        # fichiers nouveaux ou modifiés sont relus
+        cache = _load_cache(self.cache_path) if self.cache_path else {}
+        cache_keys = [None] * len(file_paths)
+        to_analyze = []
+        for i, file_path in enumerate(file_paths):
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                to_analyze.append(i)
+                continue
+            key = os.path.abspath(file_path)
+            stamp = (st.st_mtime_ns, st.st_size, self.collect_details)
+            cache_keys[i] = (key, stamp)
+            entry = cache.get(key)
+            if entry is not None and entry[0] == stamp:
+                results[i] = entry[1]
+            else:
+                to_analyze.append(i)
 
-    def analyze_codebase(self):
-        for subdir, _, files in os.walk(self.root_dir):
-            for file in files:
-                if file.endswith(('.c', '.h')):
-                    file_path = os.path.join(subdir, file)
-                    self.analyze_file(file_path)
-                    self.files_analyzed += 1
+        # Fichiers indépendants : analyse en parallèle, fusion dans l'ordre du parcours
+        if to_analyze:
+            with ProcessPoolExecutor() as executor:
+                fresh = executor.map(_analyze_file_worker, [file_paths[i] for i in to_analyze],
+                                     repeat(self.collect_details), chunksize=32)
+                for i, result in zip(to_analyze, fresh):
+                    results[i] = result
+                    if result is not None and cache_keys[i] is not None:
+                        key, stamp = cache_keys[i]
+                        cache[key] = (stamp, result)
 
-        print(f"\nAnalyzed {self.files_analyzed} files.")
-        self.visualize_results()
+        for file_path, result in zip(file_paths, results):
+            self._merge_file_result(file_path, result)
+            self.files_analyzed += 1
 
+        if self.cache_path and to_analyze:
+            _save_cache(self.cache_path, cache)
+
+        if not quiet:
+            print(f"\nAnalyzed {self.files_analyzed} files.")
+
+        # Graphiques seulement sur demande : évite le coût d'import de matplotlib
+        if plot or out:
+            self.visualize_results(out)
+
+        if quiet:
+            return
         if self.gcode_stats:
             print("\nG-code Instruction Summary:")
             for instr, count in sorted(self.gcode_stats.items(), key=lambda x: x[1], reverse=True):
@@ -35,64 +270,53 @@ class CodeAnalyzer:
             print("\nNo G-code instructions found.")
 
     def analyze_file(self, file_path: str):
-        try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                for line_num, line in enumerate(file, 1):
-                    line = line.strip()
+        self._merge_file_result(file_path, _analyze_file_worker(file_path, self.collect_details))
 
-                    # Analyse directives préprocesseur
-                    self._analyze_directive(line, file_path, line_num)
+    def _merge_file_result(self, file_path: str, result):
+        if result is None:
+            return
+        directive_counts, macro_events, max_depth, gcode_stats, gcode_codes, gcode_lines = result
 
-                    # Recherche de G-code (dans TOUTES les lignes, y compris commentées)
-                    self._analyze_gcode_line(line, file_path, line_num)
-        except Exception as e:
-            print(f"Error reading {file_path}: {e}")
+        self.directive_counts.update(directive_counts)
 
-    def _analyze_directive(self, line: str, file_path: str, line_num: int):
-        directive_match = re.match(r'#\s*(ifdef|ifndef|if|elif|else|endif|define|undef)\b\s*(\w+)?', line)
-        if directive_match:
-            directive = directive_match.group(1)
-            macro = directive_match.group(2)
-
-            self.directive_counts[directive] += 1
-
-            if directive == 'define' and macro:
+        for directive, macro in macro_events:
+            if directive == 'define':
                 self.defined_macros.add(macro)
-            elif directive == 'undef' and macro:
+            elif directive == 'undef':
                 self.defined_macros.discard(macro)
-            elif directive in {'ifdef', 'ifndef'} and macro:
-                if macro not in self.defined_macros:
-                    self.undefined_macros[macro] += 1
-
-            if directive in {'ifdef', 'ifndef', 'if'}:
-                self.condition_stack.append((directive, macro, file_path, line_num))
-            elif directive == 'endif':
-                if self.condition_stack:
-                    self.condition_stack.pop()
-
-    def _analyze_gcode_line(self, line: str, file_path: str, line_num: int):
-        matches = re.findall(r'\bG([0-9]{1,2})\b', line)
-        for match in matches:
-            gcode = f"G{match}"
-            self.gcode_stats[gcode] += 1
-            self.gcode_instructions.append({
-                "instruction": gcode,
-                "file": file_path,
-                "line": line_num,
-                "full_line": line
-            })
-
-    def visualize_results(self):
-        plt.figure(figsize=(18, 10))
+            elif macro not in self.defined_macros:
+                self.undefined_macros[macro] = self.undefined_macros.get(macro, 0) + 1
+
+        self.max_depth = max(self.max_depth, max_depth)
+
+        self.gcode_stats.update(gcode_stats)
+        if gcode_lines:
+            file_id = self._file_idx.get(file_path)
+            if file_id is None:
+                file_id = self._file_idx[file_path] = len(self.files)
+                self.files.append(file_path)
+            self.gi_file_id.extend(array('i', [file_id]) * len(gcode_lines))
+            self.gi_line.extend(gcode_lines)
+            self.gi_code.extend(map(sys.intern, gcode_codes))
+
+    def visualize_results(self, out: str = None):
+        # Import différé : matplotlib n'est chargé que si un graphique est produit.
+        # Avec out, rendu hors écran (Agg) : pas d'initialisation Tk/GTK ni de fenêtre bloquante
+        import matplotlib
+        if out:
+            matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
+        fig, axes = plt.subplots(1, 3, figsize=(18, 10))
 
         # 1. Histogramme des directives
-        plt.subplot(1, 3, 2)
+        ax = axes[1]
         keys = list(self.directive_counts.keys())
         values = [self.directive_counts[k] for k in keys]
-        plt.bar(keys, values, color='skyblue')
-        plt.title("Preprocessor Directives Frequency")
-        plt.xlabel("Directive")
-        plt.ylabel("Count")
+        ax.bar(keys, values, color='skyblue')
+        ax.set_title("Preprocessor Directives Frequency")
+        ax.set_xlabel("Directive")
+        ax.set_ylabel("Count")
 
         """         
         # 2. Macros définies
@@ -115,36 +339,48 @@ class CodeAnalyzer:
         """         
         # 4. Profondeur des #if imbriqués
         plt.subplot(2, 3, 4)
-        if self.condition_stack:
-            depths = [len(self.condition_stack)]
-        else:
-            depths = [0]
-        plt.bar(['Max Depth'], [max(depths)], color='purple')
+        plt.bar(['Max Depth'], [self.max_depth], color='purple')
         plt.title("Max Nested Conditional Depth") """
 
         # 5. Nombre de fichiers analysés
-        plt.subplot(1, 3, 1)
-        plt.bar(['Files'], [self.files_analyzed], color='green')
-        plt.title("Files Analyzed")
+        ax = axes[0]
+        ax.bar(['Files'], [self.files_analyzed], color='green')
+        ax.set_title("Files Analyzed")
 
         # 6. Instructions G-code
         if self.gcode_stats:
-            plt.subplot(1, 3, 3)
+            ax = axes[2]
             sorted_gcodes = sorted(self.gcode_stats.items(), key=lambda x: x[1], reverse=True)[:15]
-            plt.barh([g[0] for g in sorted_gcodes], [g[1] for g in sorted_gcodes], color='limegreen')
-            plt.title("Top G-code Instructions")
-            plt.xlabel("Occurrences")
+            ax.barh([g[0] for g in sorted_gcodes], [g[1] for g in sorted_gcodes], color='limegreen')
+            ax.set_title("Top G-code Instructions")
+            ax.set_xlabel("Occurrences")
+        else:
+            fig.delaxes(axes[2])
 
-        plt.tight_layout()
-        plt.show()
+        fig.tight_layout()
+        if out:
+            fig.savefig(out, dpi=100)
+            plt.close(fig)
+        else:
+            plt.show()
 
 
 if __name__ == "__main__":
     import argparse
 
-    parser = argparse.ArgumentParser(description="Analyze C code for preprocessor directives and G-code mentions.")
+    parser = argparse.ArgumentParser(description="Analyze C code for preprocessor directives and G-code mentions.",
+                                     epilog="The analyzer is pure Python and runs unchanged under PyPy, whose JIT "
+                                            "speeds up large trees: pypy3 gcode_parser_marlin.py PATH")
     parser.add_argument("path", help="Path to the root directory of the codebase.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help=f"Re-parse every file instead of reusing results cached in {_DEFAULT_CACHE_PATH}.")
+    parser.add_argument("--plot", action="store_true",
+                        help="Show the charts (matplotlib is only imported when plotting).")
+    parser.add_argument("--out", metavar="PATH",
+                        help="Save the charts to this image file instead of opening a window (implies --plot).")
+    parser.add_argument("--quiet", action="store_true",
+                        help="Do not print the text summary.")
     args = parser.parse_args()
 
-    analyzer = CodeAnalyzer(args.path)
-    analyzer.analyze_codebase()
+    analyzer = CodeAnalyzer(args.path, cache_path=None if args.no_cache else _DEFAULT_CACHE_PATH)
+    analyzer.analyze_codebase(plot=args.plot, out=args.out, quiet=args.quiet)